@@ -10,22 +10,98 @@ import warnings
 
 # numpy
 import numpy as np
+from joblib import Parallel, delayed
+from numba import njit, prange
+from scipy.spatial import cKDTree
 # sklearn imports
-from sklearn.neighbors import KDTree
 from sklearn.utils import check_array
 from sklearn.utils.validation import check_is_fitted
 from sklearn.utils.validation import check_random_state
 
 # PyOD imports
 from pyod.models.base import BaseDetector
-from pyod.utils.stat_models import pearsonr
-from pyod.utils.utility import argmaxn
 from pyod.utils.utility import check_detector
-from pyod.utils.utility import generate_bagging_indices
 from pyod.utils.utility import standardizer
 
 
-# TODO: find random state that is causing runtime warning in pearson
+@njit(parallel=True)
+def _pearson_corr(X, y, indptr, indices):  # pragma: no cover
+    """Internal function to calculate the pearson correlation between each
+    column of X and y within each local region using optimized numba code.
+    Do not use.
+
+    Constant columns (or a constant y) have an undefined correlation and
+    are assigned 0.
+
+    Parameters
+    ----------
+    X : numpy array of shape (n_samples, n_columns)
+        Input samples
+
+    y : numpy array of shape (n_samples,)
+        Target vector
+
+    indptr : numpy array of shape (n_regions + 1,)
+        Region i is made of the rows ``indices[indptr[i]:indptr[i + 1]]``.
+        Each region must hold at least two rows.
+
+    indices : numpy array of shape (n_indices,)
+        Row indices of all regions, one region after another.
+
+    Returns
+    -------
+    corr : numpy array of shape (n_regions, n_columns)
+        Pearson correlation between each column of X and y, per region
+    """
+    n_regions = indptr.shape[0] - 1
+    n_columns = X.shape[1]
+    corr = np.zeros((n_regions, n_columns))
+
+    for i in prange(n_regions):
+        rows = indices[indptr[i]:indptr[i + 1]]
+        n_rows = rows.shape[0]
+
+        # with two samples the correlation is exactly -1, 0 or 1
+        if n_rows == 2:
+            y_sign = np.sign(y[rows[1]] - y[rows[0]])
+            for d in range(n_columns):
+                corr[i, d] = np.sign(X[rows[1], d] - X[rows[0], d]) * y_sign
+            continue
+
+        # first pass over the region rows: local means of all columns
+        x_mean = np.zeros(n_columns)
+        y_mean = 0.
+        for r in rows:
+            y_mean += y[r]
+            for d in range(n_columns):
+                x_mean[d] += X[r, d]
+        x_mean /= n_rows
+        y_mean /= n_rows
+
+        # second pass: centered dot products and squared norms together
+        dot = np.zeros(n_columns)
+        x_norm = np.zeros(n_columns)
+        y_norm = 0.
+        for r in rows:
+            y_centered = y[r] - y_mean
+            y_norm += y_centered * y_centered
+            for d in range(n_columns):
+                x_centered = X[r, d] - x_mean[d]
+                dot[d] += x_centered * y_centered
+                x_norm[d] += x_centered * x_centered
+
+        if y_norm == 0:
+            continue
+
+        for d in range(n_columns):
+            if x_norm[d] > 0:
+                # guard against rounding errors pushing the correlation
+                # outside [-1, 1]
+                corr[i, d] = min(max(
+                    dot[d] / np.sqrt(x_norm[d] * y_norm), -1.), 1.)
+
+    return corr
+
 
 class LSCP(BaseDetector):
     """ Locally Selection Combination in Parallel Outlier Ensembles
@@ -81,6 +157,20 @@ class LSCP(BaseDetector):
         the proportion of outliers in the data set. Used when fitting to
         define the threshold on the decision function (0.1 by default).
 
+    n_jobs : int, optional (default = 1)
+        The number of parallel jobs to run for fitting and scoring the base
+        detectors, and for the neighbors search when defining the local
+        regions. Base detectors run in threads.
+        If ``-1``, then the number of jobs is set to the number of CPU cores.
+
+    approx_nn_threshold : int or None, optional (default=None)
+        If set, the local regions are found with approximate nearest
+        neighbors (NN-Descent from pynndescent) instead of exact KDTree
+        queries when the training data has more than ``approx_nn_threshold``
+        samples. This scales better to large training sets at the cost of
+        occasionally missing a true neighbor. Requires pynndescent.
+        None always uses exact queries.
+
     Attributes
     ----------
     decision_scores_ : numpy array of shape (n_samples,)
@@ -117,7 +207,8 @@ class LSCP(BaseDetector):
 
     def __init__(self, detector_list, local_region_size=30,
                  local_max_features=1.0, n_bins=10,
-                 random_state=None, contamination=0.1):
+                 random_state=None, contamination=0.1, n_jobs=1,
+                 approx_nn_threshold=None):
         super(LSCP, self).__init__(contamination=contamination)
         self.detector_list = detector_list
         self.n_clf = len(self.detector_list)
@@ -131,6 +222,8 @@ class LSCP(BaseDetector):
         self.n_bins = n_bins
         self.n_selected = 1
         self.random_state = random_state
+        self.n_jobs = n_jobs
+        self.approx_nn_threshold = approx_nn_threshold
 
     def fit(self, X, y=None):
         """Fit detector. y is ignored in unsupervised methods.
@@ -163,16 +256,36 @@ class LSCP(BaseDetector):
 
         # normalize input data
         self.X_train_norm_ = X
-        train_scores = np.zeros([self.X_train_norm_.shape[0], self.n_clf])
+        # scores are kept in single precision, which is enough for ranking
+        # and halves the memory traffic of the local region computations
+        train_scores = np.zeros([self.X_train_norm_.shape[0], self.n_clf],
+                                dtype=np.float32)
 
         # fit each base detector and calculate standardized train scores
+        Parallel(n_jobs=self.n_jobs, prefer='threads')(
+            delayed(detector.fit)(self.X_train_norm_)
+            for detector in self.detector_list)
         for k, detector in enumerate(self.detector_list):
-            detector.fit(self.X_train_norm_)
             train_scores[:, k] = detector.decision_scores_
         self.train_scores_ = train_scores
 
-        # set decision scores and threshold
-        self.decision_scores_ = self._get_decision_scores(X)
+        # standardize train scores once; the same statistics are reused to
+        # standardize the test scores of every later scoring call
+        self._train_scores_norm_, scaler = standardizer(train_scores,
+                                                        keep_scalar=True)
+        self._train_scores_mean_ = scaler.mean_
+        self._train_scores_std_ = scaler.scale_
+
+        # generate pseudo target for training --> for calculating weights
+        self.training_pseudo_label_ = self._train_scores_norm_.max(axis=1)
+
+        # build the trees used to find the local region of test instances
+        self._fit_local_region_trees()
+
+        # set decision scores and threshold, reusing the train scores of the
+        # base detectors instead of scoring the training data again
+        self.decision_scores_ = self._get_decision_scores(
+            X, test_scores_norm=self._train_scores_norm_)
         self._process_decision_scores()
 
         return self
@@ -211,7 +324,7 @@ class LSCP(BaseDetector):
         decision_scores = self._get_decision_scores(X)
         return decision_scores
 
-    def _get_decision_scores(self, X):
+    def _get_decision_scores(self, X, test_scores_norm=None):
         """ Helper function for getting outlier scores on test data X (note:
         model must already be fit)
 
@@ -220,6 +333,10 @@ class LSCP(BaseDetector):
         X : numpy array, shape (n_samples, n_features)
             Test data
 
+        test_scores_norm : numpy array, shape (n_samples, n_clf), optional
+            Standardized base detector scores of X, if already known.
+            Otherwise they are computed with the base detectors.
+
         Returns
         -------
         pred_scores_ens : numpy array, shape (n_samples,)
@@ -236,47 +353,137 @@ class LSCP(BaseDetector):
 
         # standardize test data and get local region for each test instance
         X_test_norm = X
-        test_local_regions = self._get_local_region(X_test_norm)
+        indptr, indices = self._get_local_region(X_test_norm)
+
+        if test_scores_norm is None:
+            # calculate test scores
+            test_scores_norm = np.empty([X_test_norm.shape[0], self.n_clf],
+                                        dtype=np.float32)
+            all_test_scores = Parallel(n_jobs=self.n_jobs, prefer='threads')(
+                delayed(detector.decision_function)(X_test_norm)
+                for detector in self.detector_list)
+            for k, test_scores in enumerate(all_test_scores):
+                test_scores_norm[:, k] = test_scores
+
+            # standardize test scores in place with the statistics of the
+            # train scores
+            np.subtract(test_scores_norm, self._train_scores_mean_,
+                        out=test_scores_norm)
+            np.divide(test_scores_norm, self._train_scores_std_,
+                      out=test_scores_norm)
+
+        # calculate pearson correlation between local pseudo ground truth
+        # and local train scores for all test instances and detectors
+        pearson_corr_scores = _pearson_corr(
+            self._train_scores_norm_, self.training_pseudo_label_, indptr,
+            indices)
+
+        # average the scores of the competent detectors of each instance
+        competent = self._get_competent_detectors(pearson_corr_scores)
+        pred_scores_ens = np.sum(test_scores_norm, axis=1, where=competent,
+                                 dtype=np.float64) / competent.sum(axis=1)
 
-        # calculate test scores
-        test_scores = np.zeros([X_test_norm.shape[0], self.n_clf])
-        for k, detector in enumerate(self.detector_list):
-            test_scores[:, k] = detector.decision_function(X_test_norm)
+        return pred_scores_ens
 
-        # generate standardized scores
-        train_scores_norm, test_scores_norm = standardizer(self.train_scores_,
-                                                           test_scores)
+    def _fit_local_region_trees(self):
+        """ Generate the random feature subspaces used to define the local
+        regions and build a KDTree out of the training data in each of them.
+        Training data is fixed after fit, so the trees are reused by every
+        scoring call.
+        """
 
-        # generate pseudo target for training --> for calculating weights
-        self.training_pseudo_label_ = np.max(train_scores_norm,
-                                             axis=1).reshape(-1, 1)
-
-        # placeholder for ensemble predictions
-        pred_scores_ens = np.zeros([X_test_norm.shape[0], ])
-
-        # iterate through test instances (test_local_regions
-        # indices correspond to x_test)
-        for i, test_local_region in enumerate(test_local_regions):
-
-            # get pseudo target and training scores in local region of
-            # test instance
-            local_pseudo_ground_truth = self.training_pseudo_label_[
-                test_local_region,].ravel()
-            local_train_scores = train_scores_norm[test_local_region, :]
-
-            # calculate pearson correlation between local pseudo ground truth
-            # and local train scores
-            pearson_corr_scores = np.zeros([self.n_clf, ])
-            for d in range(self.n_clf):
-                pearson_corr_scores[d,] = pearsonr(
-                    local_pseudo_ground_truth, local_train_scores[:, d])[0]
-
-            # return best score
-            pred_scores_ens[i,] = np.mean(
-                test_scores_norm[
-                    i, self._get_competent_detectors(pearson_corr_scores)])
+        # neither exact nor approximate neighbor queries can return more
+        # distinct points than the training data, so check before building
+        # either kind of index
+        if self.local_region_size > self.X_train_norm_.shape[0]:
+            raise ValueError("k must be less than or equal to the number of "
+                             "training points")
 
-        return pred_scores_ens
+        if self.local_max_features > 1.0:
+            warnings.warn(
+                "Local max features greater than 1.0, reducing to 1.0")
+            self.local_max_features = 1.0
+
+        if self.X_train_norm_.shape[1] * self.local_min_features < 1:
+            warnings.warn(
+                "Local min features smaller than 1, increasing to 1.0")
+            self.local_min_features = 1.0
+
+        n_features = self.X_train_norm_.shape[1]
+
+        # if min and max are the same, then use all features
+        if self.local_max_features == self.local_min_features:
+            warnings.warn("Local min features equals local max features; "
+                          "use all features instead.")
+            subspaces = [np.arange(n_features)] * \
+                        self.local_region_iterations
+
+        else:
+            # randomly generate all feature subspaces at once: one draw for
+            # the subspace sizes and one for the feature permutations
+            subspace_sizes = self.random_state.randint(
+                int(n_features * self.local_min_features),
+                int(n_features * self.local_max_features),
+                size=self.local_region_iterations)
+            permutations = np.argsort(self.random_state.rand(
+                self.local_region_iterations, n_features), axis=1)
+            subspaces = [permutation[:size] for permutation, size in
+                         zip(permutations, subspace_sizes)]
+
+        # iterations which draw the same subspace share its tree, so only
+        # keep the distinct subspaces and how often each was drawn
+        subspace_counts = collections.Counter(
+            tuple(np.sort(features)) for features in subspaces)
+        self._subspace_features_ = [np.array(features) for features in
+                                    subspace_counts]
+        self._subspace_counts_ = list(subspace_counts.values())
+
+        if self.approx_nn_threshold is not None and \
+                self.X_train_norm_.shape[0] > self.approx_nn_threshold:
+            try:
+                from pynndescent import NNDescent
+            except ImportError:
+                raise ImportError(
+                    "please install pynndescent first for approximate "
+                    "nearest neighbors by `pip install pynndescent`")
+
+            # build an approximate NN index out of each distinct training
+            # subspace
+            self._subspace_trees_ = [
+                NNDescent(self.X_train_norm_[:, features],
+                          random_state=self.random_state, n_jobs=self.n_jobs)
+                for features in self._subspace_features_]
+
+        else:
+            # build KDTree out of each distinct training subspace
+            self._subspace_trees_ = [
+                cKDTree(self.X_train_norm_[:, features])
+                for features in self._subspace_features_]
+
+    def _query_local_region_tree(self, tree, X_test_norm):
+        """ Find the local_region_size nearest training samples of each test
+        instance with a tree built by _fit_local_region_trees
+
+        Parameters
+        ----------
+        tree : cKDTree or NNDescent
+            Tree built out of a training subspace
+
+        X_test_norm : numpy array, shape (n_samples, n_subspace_features)
+            Normalized test data in the same subspace
+
+        Returns
+        -------
+        ind_arr : numpy array, shape (n_samples, local_region_size)
+            Indices of the nearest training samples of each test sample
+        """
+
+        if isinstance(tree, cKDTree):
+            _, ind_arr = tree.query(X_test_norm, k=self.local_region_size,
+                                    workers=self.n_jobs)
+        else:
+            ind_arr, _ = tree.query(X_test_norm, k=self.local_region_size)
+        return ind_arr
 
     def _get_local_region(self, X_test_norm):
         """ Get local region for each test instance
@@ -288,91 +495,93 @@ class LSCP(BaseDetector):
 
         Returns
         -------
-        final_local_region_list : List of lists, shape of [n_samples, [local_region]]
-            Indices of training samples in the local region of each test sample
-        """
+        indptr : numpy array, shape (n_samples + 1,)
+            The local region of test sample i is made of the training samples
+            ``indices[indptr[i]:indptr[i + 1]]``
 
-        # Initialize the local region list
-        local_region_list = [[]] * X_test_norm.shape[0]
-
-        if self.local_max_features > 1.0:
-            warnings.warn(
-                "Local max features greater than 1.0, reducing to 1.0")
-            self.local_max_features = 1.0
-
-        if self.X_train_norm_.shape[1] * self.local_min_features < 1:
-            warnings.warn(
-                "Local min features smaller than 1, increasing to 1.0")
-            self.local_min_features = 1.0
+        indices : numpy array, shape (n_indices,)
+            Indices of training samples in the local region of each test
+            sample, one local region after another
+        """
 
-        # perform multiple iterations
-        for _ in range(self.local_region_iterations):
-
-            # if min and max are the same, then use all features
-            if self.local_max_features == self.local_min_features:
-                features = range(0, self.X_train_norm_.shape[1])
-                warnings.warn("Local min features equals local max features; "
-                              "use all features instead.")
-
-            else:
-                # randomly generate feature subspaces
-                features = generate_bagging_indices(
-                    self.random_state,
-                    bootstrap_features=False,
-                    n_features=self.X_train_norm_.shape[1],
-                    min_features=int(
-                        self.X_train_norm_.shape[1] * self.local_min_features),
-                    max_features=int(
-                        self.X_train_norm_.shape[1] * self.local_max_features))
-
-            # build KDTree out of training subspace
-            tree = KDTree(self.X_train_norm_[:, features])
+        n_test = X_test_norm.shape[0]
+        k = self.local_region_size
+
+        if len(self._subspace_trees_) == 1:
+            # all iterations use the same subspace, so every neighbor occurs
+            # in every iteration and the neighbors are the local region
+            features, tree = self._subspace_features_[0], \
+                             self._subspace_trees_[0]
+            ind_arr = self._query_local_region_tree(tree,
+                                                    X_test_norm[:, features])
+            return np.arange(0, n_test * k + 1, k), ind_arr.ravel()
+
+        # preallocate the neighbors found over all iterations
+        neighbors = np.empty([n_test, self.local_region_iterations * k],
+                             dtype=np.intp)
+
+        # perform multiple iterations over the cached subspace trees, querying
+        # each distinct subspace once
+        start = 0
+        for features, tree, count in zip(self._subspace_features_,
+                                         self._subspace_trees_,
+                                         self._subspace_counts_):
 
             # Find neighbors of each test instance
-            _, ind_arr = tree.query(X_test_norm[:, features],
-                                    k=self.local_region_size)
-
-            # add neighbors to local region list
-            for j in range(X_test_norm.shape[0]):
-                local_region_list[j] = local_region_list[j] + \
-                                       ind_arr[j, :].tolist()
+            ind_arr = self._query_local_region_tree(tree,
+                                                    X_test_norm[:, features])
+
+            # add neighbors to local region list, once per iteration which
+            # drew this subspace
+            for _ in range(count):
+                neighbors[:, start:start + k] = ind_arr
+                start += k
+
+        # count the occurrences of each neighbor; once each row is sorted,
+        # repeated neighbors are consecutive
+        neighbors.sort(axis=1)
+        is_first = np.ones(neighbors.shape, dtype=bool)
+        is_first[:, 1:] = neighbors[:, 1:] != neighbors[:, :-1]
+        first_ind = np.flatnonzero(is_first)
+        items = neighbors.ravel()[first_ind]
+        counts = np.diff(np.append(first_ind, neighbors.size))
+        rows = first_ind // neighbors.shape[1]
+        row_ptr = np.searchsorted(rows, np.arange(n_test + 1))
 
         # keep nearby points which occur at least local_region_threshold times
-        final_local_region_list = [[]] * X_test_norm.shape[0]
-        for j in range(X_test_norm.shape[0]):
-            tmp = [item for item, count in collections.Counter(
-                local_region_list[j]).items() if
-                   count > self.local_region_threshold]
+        keep = counts > self.local_region_threshold
+        n_kept = np.bincount(rows[keep], minlength=n_test)
+
+        # lower the threshold for test instances with less than 2 points
+        for j in np.flatnonzero(n_kept < 2):
+            row = slice(row_ptr[j], row_ptr[j + 1])
             decrease_value = 0
-            while len(tmp) < 2:
+            while np.count_nonzero(keep[row]) < 2:
                 decrease_value = decrease_value + 1
                 assert decrease_value < self.local_region_threshold
-                tmp = [item for item, count in
-                       collections.Counter(local_region_list[j]).items() if
-                       count > (self.local_region_threshold - decrease_value)]
+                keep[row] = counts[row] > (self.local_region_threshold -
+                                           decrease_value)
+            n_kept[j] = np.count_nonzero(keep[row])
 
-            final_local_region_list[j] = tmp
+        indptr = np.zeros(n_test + 1, dtype=np.intp)
+        np.cumsum(n_kept, out=indptr[1:])
 
-        return final_local_region_list
+        return indptr, items[keep]
 
     def _get_competent_detectors(self, scores):
         """ Identifies competent base detectors based on correlation scores
 
         Parameters
         ----------
-        scores : numpy array, shape (n_clf,)
-            Correlation scores for each classifier (for a specific
-            test instance)
+        scores : numpy array, shape (n_samples, n_clf)
+            Correlation scores for each classifier (for each test instance)
 
         Returns
         -------
-        candidates : List
-            Indices for competent detectors (for given test instance)
+        candidates : numpy array of bool, shape (n_samples, n_clf)
+            Whether each detector is competent for each test instance
         """
 
-        # create histogram of correlation scores
-        scores = scores.reshape(-1, 1)
-
         # TODO: handle when Pearson score is 0
         # if scores contain nan, change it to 0
         if np.isnan(scores).any():
@@ -383,22 +592,33 @@ class LSCP(BaseDetector):
                 "The number of histogram bins is greater than the number of "
                 "classifiers, reducing n_bins to n_clf.")
             self.n_bins = self.n_clf
-        hist, bin_edges = np.histogram(scores, bins=self.n_bins)
-
-        # find n_selected largest bins
-        max_bins = argmaxn(hist, n=self.n_selected)
-        candidates = []
-
-        # iterate through bins
-        for max_bin in max_bins:
-            # determine which detectors are inside this bin
-            selected = np.where((scores >= bin_edges[max_bin])
-                                & (scores <= bin_edges[max_bin + 1]))
-
-            # add to list of candidates
-            candidates = candidates + selected[0].tolist()
 
-        return candidates
+        # create histogram of correlation scores for each test instance,
+        # with the same bin edges as np.histogram
+        first_edges = scores.min(axis=1)
+        last_edges = scores.max(axis=1)
+        same = first_edges == last_edges
+        first_edges[same] -= 0.5
+        last_edges[same] += 0.5
+        inner_edges = np.linspace(first_edges, last_edges, self.n_bins + 1,
+                                  axis=1)[:, np.newaxis, 1:-1]
+
+        # assign each detector to its bin; bins are closed on both sides, so
+        # a detector on an inner edge belongs to the bins on either side
+        scores = scores[:, :, np.newaxis]
+        left_bins = np.count_nonzero(scores > inner_edges, axis=2)
+        right_bins = np.count_nonzero(scores >= inner_edges, axis=2)
+        hist = np.count_nonzero(
+            right_bins[:, :, np.newaxis] == np.arange(self.n_bins), axis=1)
+
+        # find n_selected largest bins, including ties as argmaxn does
+        threshold = np.partition(hist, self.n_bins - self.n_selected,
+                                 axis=1)[:, [self.n_bins - self.n_selected]]
+        max_bins = hist >= threshold
+
+        # determine which detectors are inside the largest bins
+        return np.take_along_axis(max_bins, left_bins, axis=1) | \
+               np.take_along_axis(max_bins, right_bins, axis=1)
 
     def __len__(self):
         return len(self.detector_list)
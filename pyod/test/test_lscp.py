@@ -8,12 +8,15 @@ import sys
 import unittest
 from os import path
 
+import numpy as np
 # noinspection PyProtectedMember
 from numpy.testing import assert_allclose
 from numpy.testing import assert_array_less
 from numpy.testing import assert_equal
 from numpy.testing import assert_raises
 from scipy.io import loadmat
+from scipy.spatial import cKDTree
+from scipy.stats import pearsonr
 from scipy.stats import rankdata
 from sklearn.base import clone
 from sklearn.metrics import roc_auc_score
@@ -25,6 +28,7 @@ from sklearn.utils.validation import check_X_y
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from pyod.models.lscp import LSCP
+from pyod.models.lscp import _pearson_corr
 from pyod.models.lof import LOF
 from pyod.utils.data import generate_data
 
@@ -159,6 +163,86 @@ class TestLSCP(unittest.TestCase):
         assert_array_less(pred_ranks, 1.01)
         assert_array_less(-0.1, pred_ranks)
 
+    def test_prediction_scores_repeated(self):
+        # local region subspaces are fixed at fit time
+        assert_allclose(self.clf.decision_function(self.X_test),
+                        self.clf.decision_function(self.X_test))
+
+    def test_local_region(self):
+        indptr, indices = self.clf._get_local_region(self.X_test)
+        assert_equal(indptr.shape, (self.X_test.shape[0] + 1,))
+        assert_equal(indptr[-1], indices.shape[0])
+        assert_array_less(1, np.diff(indptr))
+        assert_array_less(indices, self.X_train.shape[0])
+
+    def test_subspace_features(self):
+        n_features = self.X_train.shape[1]
+        assert_equal(sum(self.clf._subspace_counts_),
+                     self.clf.local_region_iterations)
+        for features in self.clf._subspace_features_:
+            assert (n_features // 2 <= len(features) < n_features)
+            assert_equal(len(np.unique(features)), len(features))
+
+        # use all features when min and max features are the same
+        clf = LSCP([LOF(), LOF()], local_max_features=0.5)
+        clf.fit(self.X_train)
+        assert_equal(len(clf._subspace_trees_), 1)
+        assert_equal(clf._subspace_features_[0], np.arange(n_features))
+
+        # every neighbor of the shared subspace is in the local region
+        indptr, indices = clf._get_local_region(self.X_test)
+        assert_equal(np.diff(indptr), clf.local_region_size)
+
+    def test_local_region_size(self):
+        # local regions cannot be larger than the training data
+        clf = LSCP([LOF(n_neighbors=5), LOF(n_neighbors=10)],
+                   local_region_size=30)
+        with assert_raises(ValueError):
+            clf.fit(self.X_train[:25])
+
+        # the same holds with approximate neighbors
+        clf = LSCP([LOF(n_neighbors=5), LOF(n_neighbors=10)],
+                   local_region_size=150, approx_nn_threshold=100)
+        with assert_raises(ValueError):
+            clf.fit(self.X_train[:120])
+
+    def test_n_jobs(self):
+        clf = LSCP([LOF(), LOF()], random_state=42, n_jobs=2)
+        clf.fit(self.X_train)
+        ref = LSCP([LOF(), LOF()], random_state=42)
+        ref.fit(self.X_train)
+        assert_allclose(clf.decision_function(self.X_test),
+                        ref.decision_function(self.X_test))
+
+    def test_approx_nn(self):
+        # equal min and max features share a single subspace, so only one
+        # approximate index is built
+        clf = LSCP([LOF(), LOF()], local_max_features=0.5,
+                   approx_nn_threshold=100)
+        clf.fit(self.X_train[:150])
+        assert_equal(len(clf._subspace_trees_), 1)
+        assert (not isinstance(clf._subspace_trees_[0], cKDTree))
+
+        pred_scores = clf.decision_function(self.X_test)
+        assert_equal(pred_scores.shape[0], self.X_test.shape[0])
+        assert (roc_auc_score(self.y_test, pred_scores) >= self.roc_floor)
+
+    def test_pearson_corr(self):
+        X = self.clf.train_scores_[:50]
+        y = X.max(axis=1)
+        indptr = np.array([0, 2, 20, 50])
+        corr = _pearson_corr(X, y, indptr, np.arange(50))
+        assert_equal(corr.shape, (3, X.shape[1]))
+        for i in range(3):
+            rows = slice(indptr[i], indptr[i + 1])
+            for d in range(X.shape[1]):
+                assert_allclose(corr[i, d], pearsonr(X[rows, d], y[rows])[0])
+
+        # constant columns have no defined correlation
+        assert_equal(_pearson_corr(np.ones([10, 2]), np.arange(10.),
+                                   np.array([0, 2, 10]), np.arange(10)),
+                     np.zeros([2, 2]))
+
     def test_model_clone(self):
         clone_clf = clone(self.clf)
 